@@ -1,18 +1,17 @@
 import asyncio
-import json
+import contextlib
+import hashlib
 import os
 import tomllib
 import traceback
 from typing import Dict, List, Optional, Union, Any
 import uuid
 import time
-import threading
 
 import aiohttp
+import orjson
 from fastapi import FastAPI, Request, Response, Depends, HTTPException, Header
-from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
-import uvicorn
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from loguru import logger
 
 from WechatAPI import WechatAPIClient
@@ -21,6 +20,78 @@ from utils.decorators import *
 from utils.plugin_base import PluginBase
 
 
+class _RelayStreamingResponse(StreamingResponse):
+    """转发上游的流式响应，发送结束或客户端提前断开后都会执行清理"""
+
+    def __init__(self, content, on_close, **kwargs):
+        super().__init__(content, **kwargs)
+        self._on_close = on_close
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            self._on_close()
+
+
+class _AllowAllCORSMiddleware:
+    """允许所有来源跨域访问的ASGI中间件，直接应答预检请求"""
+
+    _cors_headers = [
+        (b"access-control-allow-origin", b"*"),
+        (b"access-control-allow-methods", b"*"),
+        (b"access-control-allow-headers", b"*"),
+    ]
+    # "*"不包含Authorization，预检请求未声明请求头时显式列出
+    _default_allow_headers = b"authorization, content-type, *"
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        if scope["method"] == "OPTIONS":
+            # 回显预检请求声明的请求头，使携带Authorization的浏览器请求能通过预检
+            allow_headers = self._default_allow_headers
+            for name, value in scope["headers"]:
+                if name == b"access-control-request-headers":
+                    allow_headers = value
+                    break
+            preflight_headers = [
+                *self._cors_headers[:2],
+                (b"access-control-allow-headers", allow_headers),
+            ]
+            await send({"type": "http.response.start", "status": 204, "headers": preflight_headers})
+            await send({"type": "http.response.body", "body": b""})
+            return
+
+        async def send_with_cors(message):
+            if message["type"] == "http.response.start":
+                message["headers"] = [*message.get("headers", ()), *self._cors_headers]
+            await send(message)
+
+        await self.app(scope, receive, send_with_cors)
+
+
+def _create_embedded_server(**config_kwargs):
+    """创建运行在机器人事件循环中的uvicorn服务器，不接管进程信号"""
+    # 延迟导入，插件禁用时不加载uvicorn
+    import uvicorn
+
+    class EmbeddedServer(uvicorn.Server):
+        def install_signal_handlers(self):
+            return
+
+        @contextlib.contextmanager
+        def capture_signals(self):
+            yield
+
+    return EmbeddedServer(uvicorn.Config(**config_kwargs))
+
+
 class OpenAIAPI(PluginBase):
     description = "OpenAI API兼容插件"
     author = "XYBot团队"
@@ -72,30 +143,67 @@ class OpenAIAPI(PluginBase):
             self.frequency_penalty = plugin_config.get("frequency_penalty", 0.0)
             self.presence_penalty = plugin_config.get("presence_penalty", 0.0)
             
+            # 获取并发设置
+            self.max_inflight = plugin_config.get("max_inflight", 256)
+            self.inflight_timeout = plugin_config.get("inflight_timeout", 5)
+            self._inflight = asyncio.Semaphore(self.max_inflight)
+            
+            # 预先构建默认请求参数（请求中未指定时使用）
+            self._defaults = {
+                "model": self.default_model,
+                "temperature": self.temperature,
+                "top_p": self.top_p,
+                "frequency_penalty": self.frequency_penalty,
+                "presence_penalty": self.presence_penalty
+            }
+            if self.max_tokens > 0:
+                self._defaults["max_tokens"] = self.max_tokens
+            
+            # 预先构建转发请求头
+            self._base_headers = {"Content-Type": "application/json"}
+            self._auth_header = f"Bearer {self.api_key}" if self.api_key else None
+            self._use_client_key = not self.api_key
+            
+            # 预先构建静态接口的响应内容及ETag
+            self._start_ts = int(time.time())
+            self._models_payload = {
+                "object": "list",
+                "data": [
+                    {
+                        "id": model_id,
+                        "object": "model",
+                        "created": self._start_ts,
+                        "owned_by": "organization-owner"
+                    }
+                    for model_id in self.available_models
+                ]
+            }
+            self._models_bytes, self._models_etag = self._encode_static(self._models_payload)
+            self._root_bytes, self._root_etag = self._encode_static({
+                "message": "OpenAI API兼容服务已启动",
+                "version": self.version,
+                "models": self.available_models,
+                "documentation": "/docs"
+            })
+            
             # 初始化数据库
             self.db = XYBotDB()
             
             # 获取管理员列表
             self.admins = main_config.get("XYBot", {}).get("admins", [])
             
-            # 初始化FastAPI应用
-            self.app = FastAPI(title="OpenAI API兼容服务", description="提供OpenAI API兼容的接口")
-            
-            # 添加CORS中间件
-            self.app.add_middleware(
-                CORSMiddleware,
-                allow_origins=["*"],
-                allow_credentials=True,
-                allow_methods=["*"],
-                allow_headers=["*"],
-            )
-            
             # 初始化服务器
             self.server = None
-            self.server_thread = None
+            self._server_task: Optional[asyncio.Task] = None
             
-            # 设置API路由
-            self._setup_routes()
+            # 共享的连接池和HTTP会话，在首次请求时创建
+            self._connector: Optional[aiohttp.TCPConnector] = None
+            self._session: Optional[aiohttp.ClientSession] = None
+            self._session_lock = asyncio.Lock()
+            self._completions_url = f"{self.base_url.rstrip('/')}/chat/completions"
+            
+            # FastAPI应用在插件启用时才构建
+            self.app = None
             
             logger.success("OpenAIAPI插件初始化成功")
             
@@ -104,136 +212,244 @@ class OpenAIAPI(PluginBase):
             logger.error(traceback.format_exc())
             self.enable = False
     
+    @staticmethod
+    def _encode_static(payload: dict) -> tuple[bytes, str]:
+        """序列化静态响应内容并计算ETag"""
+        content = orjson.dumps(payload)
+        etag = f'"{hashlib.blake2b(content, digest_size=16).hexdigest()}"'
+        return content, etag
+    
+    @staticmethod
+    def _static_response(request: Request, content: bytes, etag: str) -> Response:
+        """返回静态内容，客户端缓存未过期时直接返回304"""
+        headers = {"ETag": etag, "Cache-Control": "public, max-age=60"}
+        if request.headers.get("if-none-match") == etag:
+            return Response(status_code=304, headers=headers)
+        return Response(content=content, media_type="application/json", headers=headers)
+    
+    @staticmethod
+    def _error_response(status_code: int, message: str, error_type: str, code: str) -> ORJSONResponse:
+        """构建OpenAI格式的错误响应"""
+        return ORJSONResponse(
+            status_code=status_code,
+            content={
+                "error": {
+                    "message": message,
+                    "type": error_type,
+                    "code": code
+                }
+            }
+        )
+    
+    @staticmethod
+    def _encoding_headers(response: aiohttp.ClientResponse) -> Optional[dict]:
+        """获取需要透传给客户端的压缩编码响应头"""
+        content_encoding = response.headers.get("Content-Encoding")
+        return {"Content-Encoding": content_encoding} if content_encoding else None
+    
+    def _get_connector(self) -> aiohttp.TCPConnector:
+        """获取共享的连接池，所有会话共用同一组连接和DNS缓存"""
+        if self._connector is None or self._connector.closed:
+            self._connector = aiohttp.TCPConnector(
+                limit=200,
+                limit_per_host=100,
+                keepalive_timeout=75,
+                ttl_dns_cache=300,
+                enable_cleanup_closed=True
+            )
+        return self._connector
+    
+    async def _get_session(self) -> aiohttp.ClientSession:
+        """获取共享的HTTP会话，复用连接池避免每次请求重新握手"""
+        if self._session is None or self._session.closed:
+            async with self._session_lock:
+                if self._session is None or self._session.closed:
+                    self._session = aiohttp.ClientSession(
+                        connector=self._get_connector(),
+                        connector_owner=False,
+                        timeout=aiohttp.ClientTimeout(total=300)
+                    )
+        return self._session
+    
+    async def _close_session(self):
+        """关闭共享的HTTP会话及连接池"""
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+        
+        # 会话不拥有连接池，需在所有会话关闭后单独关闭
+        if self._connector is not None and not self._connector.closed:
+            await self._connector.close()
+        self._connector = None
+    
+    def _ensure_app(self) -> FastAPI:
+        """构建FastAPI应用（仅首次调用时构建）"""
+        if self.app is None:
+            # 初始化FastAPI应用
+            self.app = FastAPI(
+                title="OpenAI API兼容服务",
+                description="提供OpenAI API兼容的接口"
+            )
+            
+            # 添加CORS中间件
+            self.app.add_middleware(_AllowAllCORSMiddleware)
+            
+            # 设置API路由
+            self._setup_routes()
+        return self.app
+    
     def _setup_routes(self):
         """设置API路由"""
         
         @self.app.get("/v1/models")
-        async def list_models():
+        async def list_models(request: Request):
             """列出可用的模型"""
-            models = []
-            for model_id in self.available_models:
-                models.append({
-                    "id": model_id,
-                    "object": "model",
-                    "created": int(time.time()),
-                    "owned_by": "organization-owner"
-                })
-            
-            return {
-                "object": "list",
-                "data": models
-            }
+            return self._static_response(request, self._models_bytes, self._models_etag)
         
         @self.app.post("/v1/chat/completions")
         async def create_chat_completion(request: Request):
             """创建聊天完成"""
+            # 限制同时转发的请求数，排队超时则返回429
+            try:
+                await asyncio.wait_for(self._inflight.acquire(), timeout=self.inflight_timeout)
+            except asyncio.TimeoutError:
+                return self._error_response(429, "当前请求过多，请稍后再试", "rate_limit_error", "too_many_requests")
+            
+            # 流式响应在转发结束后才释放并发名额
+            stream_owns_slot = False
             try:
                 # 获取请求体
-                body = await request.json()
-                
-                # 获取请求头中的API密钥
-                api_key = request.headers.get("Authorization", "").replace("Bearer ", "")
+                try:
+                    body = orjson.loads(await request.body())
+                except orjson.JSONDecodeError as e:
+                    return self._error_response(400, f"请求体不是有效的JSON: {str(e)}", "invalid_request_error", "invalid_json")
+                if not isinstance(body, dict):
+                    return self._error_response(400, "请求体必须是JSON对象", "invalid_request_error", "invalid_request")
                 
                 # 构建转发请求
-                headers = {
-                    "Content-Type": "application/json"
-                }
+                headers = self._base_headers.copy()
+                
+                # 未配置API密钥时，使用请求中的API密钥
+                if self._use_client_key:
+                    auth = request.headers.get("authorization")
+                    api_key = auth[7:] if auth and auth[:7].lower() == "bearer " else auth
+                    if api_key:
+                        headers["Authorization"] = f"Bearer {api_key}"
+                # 否则使用配置的API密钥
+                else:
+                    headers["Authorization"] = self._auth_header
                 
-                # 如果配置了API密钥，使用配置的API密钥
-                if self.api_key:
-                    headers["Authorization"] = f"Bearer {self.api_key}"
-                # 否则使用请求中的API密钥
-                elif api_key:
-                    headers["Authorization"] = f"Bearer {api_key}"
+                # 透传客户端支持的压缩格式，上游响应保持压缩直接转发
+                headers["Accept-Encoding"] = request.headers.get("accept-encoding", "identity")
                 
                 # 设置代理
                 proxy = self.http_proxy if self.http_proxy else None
                 
                 # 应用默认参数（如果请求中没有指定）
-                if "model" not in body:
-                    body["model"] = self.default_model
-                
-                if "max_tokens" not in body and self.max_tokens > 0:
-                    body["max_tokens"] = self.max_tokens
-                
-                if "temperature" not in body:
-                    body["temperature"] = self.temperature
-                
-                if "top_p" not in body:
-                    body["top_p"] = self.top_p
-                
-                if "frequency_penalty" not in body:
-                    body["frequency_penalty"] = self.frequency_penalty
-                
-                if "presence_penalty" not in body:
-                    body["presence_penalty"] = self.presence_penalty
+                body = {**self._defaults, **body}
+                try:
+                    payload = orjson.dumps(body)
+                except orjson.JSONEncodeError as e:
+                    # 例如超出64位范围的整数
+                    return self._error_response(400, f"请求体包含无法转发的值: {str(e)}", "invalid_request_error", "invalid_request")
                 
                 # 转发请求到后端API
-                async with aiohttp.ClientSession() as session:
-                    async with session.post(
-                        f"{self.base_url}/chat/completions",
+                session = await self._get_session()
+                
+                # 流式请求：保持上游响应打开，边读边转发
+                if body.get("stream"):
+                    response = await session.post(
+                        self._completions_url,
                         headers=headers,
-                        json=body,
-                        proxy=proxy
-                    ) as response:
-                        # 获取响应
-                        response_json = await response.json()
-                        
-                        # 返回响应
-                        return Response(
-                            content=json.dumps(response_json),
-                            media_type="application/json",
-                            status_code=response.status
-                        )
+                        data=payload,
+                        proxy=proxy,
+                        auto_decompress=False
+                    )
+                    
+                    async def stream_upstream():
+                        # 响应头已发送，上游出错时只能记录日志并结束流
+                        try:
+                            async for chunk in response.content.iter_any():
+                                yield chunk
+                        except asyncio.TimeoutError:
+                            logger.warning("读取后端API流式响应超时")
+                        except aiohttp.ClientError as e:
+                            logger.warning("读取后端API流式响应失败: {}", e)
+                    
+                    # 生成器可能在客户端断开时从未启动，清理放在响应对象中执行
+                    def close_upstream():
+                        response.release()
+                        self._inflight.release()
+                    
+                    stream_owns_slot = True
+                    return _RelayStreamingResponse(
+                        stream_upstream(),
+                        close_upstream,
+                        status_code=response.status,
+                        media_type=response.headers.get("Content-Type", "text/event-stream"),
+                        headers=self._encoding_headers(response)
+                    )
+                
+                async with session.post(
+                    self._completions_url,
+                    headers=headers,
+                    data=payload,
+                    proxy=proxy,
+                    auto_decompress=False
+                ) as response:
+                    # 直接透传上游响应内容，避免解析后再序列化
+                    raw = await response.read()
+                    
+                    return Response(
+                        content=raw,
+                        media_type=response.headers.get("Content-Type", "application/json"),
+                        status_code=response.status,
+                        headers=self._encoding_headers(response)
+                    )
+            
+            except aiohttp.ClientResponseError as e:
+                # 未调用raise_for_status，只有重定向过多等情况会到这里，上游状态码不能直接透传
+                logger.warning("后端API返回错误: {} {}", e.status, e.message)
+                return self._error_response(502, f"后端API返回错误: {e.status} {e.message}", "upstream_error", "bad_gateway")
+            
+            except asyncio.TimeoutError:
+                logger.warning("请求后端API超时")
+                return self._error_response(504, "请求后端API超时", "upstream_error", "upstream_timeout")
+            
+            except aiohttp.ClientError as e:
+                logger.warning("连接后端API失败: {}", e)
+                return self._error_response(502, f"连接后端API失败: {str(e)}", "upstream_error", "bad_gateway")
             
             except Exception as e:
-                logger.error(f"处理聊天完成请求失败: {str(e)}")
-                logger.error(traceback.format_exc())
-                
-                return JSONResponse(
-                    status_code=500,
-                    content={
-                        "error": {
-                            "message": f"处理请求失败: {str(e)}",
-                            "type": "server_error",
-                            "code": "internal_server_error"
-                        }
-                    }
-                )
+                logger.opt(exception=True).error("处理聊天完成请求失败: {}", e)
+                return self._error_response(500, f"处理请求失败: {str(e)}", "server_error", "internal_server_error")
+            
+            finally:
+                if not stream_owns_slot:
+                    self._inflight.release()
         
         @self.app.get("/")
-        async def root():
+        async def root(request: Request):
             """API根路径"""
-            return {
-                "message": "OpenAI API兼容服务已启动",
-                "version": self.version,
-                "models": self.available_models,
-                "documentation": "/docs"
-            }
-        
-        @self.app.get("/docs")
-        async def get_docs():
-            """API文档"""
-            return {
-                "message": "访问 /docs 查看API文档",
-                "swagger_ui": "/docs",
-                "redoc": "/redoc"
-            }
+            return self._static_response(request, self._root_bytes, self._root_etag)
     
     async def _start_server(self):
         """启动API服务器"""
-        config = uvicorn.Config(
+        self.server = _create_embedded_server(
             app=self.app,
             host=self.host,
             port=self.port,
-            log_level="info"
+            log_level="warning",
+            access_log=False,
+            timeout_graceful_shutdown=5  # 关闭时最多等待未完成的连接5秒
         )
-        self.server = uvicorn.Server(config)
-        await self.server.serve()
-    
-    def _run_server(self):
-        """在线程中运行服务器"""
-        asyncio.run(self._start_server())
+        try:
+            await self.server.serve()
+        except SystemExit:
+            # uvicorn在端口绑定失败等情况下会调用sys.exit，不能让它结束整个机器人
+            logger.error(f"OpenAIAPI服务器启动失败，请检查端口 {self.port} 是否被占用")
+        finally:
+            await self._close_session()
     
     async def on_enable(self, bot=None):
         """插件启用时调用"""
@@ -245,20 +461,24 @@ class OpenAIAPI(PluginBase):
         
         # 启动API服务器
         try:
-            # 在新线程中启动服务器
-            self.server_thread = threading.Thread(target=self._run_server, daemon=True)
-            self.server_thread.start()
+            # 首次启用时构建FastAPI应用
+            self._ensure_app()
+            
+            # 在机器人的事件循环中启动服务器
+            self._server_task = asyncio.create_task(self._start_server())
             
             logger.success(f"OpenAIAPI服务器已启动，监听地址: {self.host}:{self.port}")
             
             # 发送提示消息
             if bot and self.command_tip:
-                # 向管理员发送提示
-                for admin in self.admins:
-                    try:
-                        await bot.send_text_message(admin, self.command_tip)
-                    except Exception as e:
-                        logger.error(f"向管理员 {admin} 发送提示消息失败: {str(e)}")
+                # 并发向管理员发送提示，单个管理员失败不影响其他人
+                results = await asyncio.gather(
+                    *(bot.send_text_message(admin, self.command_tip) for admin in self.admins),
+                    return_exceptions=True
+                )
+                for admin, result in zip(self.admins, results):
+                    if isinstance(result, Exception):
+                        logger.error(f"向管理员 {admin} 发送提示消息失败: {str(result)}")
         
         except Exception as e:
             logger.error(f"启动OpenAIAPI服务器失败: {str(e)}")
@@ -271,4 +491,11 @@ class OpenAIAPI(PluginBase):
             self.server.should_exit = True
             logger.info("OpenAIAPI服务器正在关闭...")
         
+        if self._server_task:
+            try:
+                await self._server_task
+            except Exception as e:
+                logger.error(f"OpenAIAPI服务器异常退出: {str(e)}")
+            self._server_task = None
+        
         await super().on_disable()